@@ -4,17 +4,33 @@ import os
 import time
 from datetime import datetime
 import csv
+import atexit
+import sys
+import queue
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 import RPi.GPIO as GPIO
 
 class LightweightFaceAttendance:
     def __init__(self, database_path="employees", attendance_log="attendance.csv"):
         self.database_path = database_path
         self.attendance_log = attendance_log
+        self.face_cache_path = "models/face_cache"
         self.recognizer = cv2.face.LBPHFaceRecognizer_create()
-        self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        self.face_cascade_path = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+        self.face_detector_model = "face_detection_yunet_2023mar.onnx"
+        self.detection_size = (160, 120)  # Frame size the YuNet detector runs on
+        self.use_yunet = self.yunet_available()
+        self.use_cuda = self.use_yunet and self.cuda_available()
+        self.detectors = threading.local()  # Face detectors are not shared between threads
         self.employee_ids = {}  # Map of ID to name
         self.led_pin = 17  # GPIO pin for success LED
         self.buzzer_pin = 18  # GPIO pin for buzzer
+        self.max_fps = 30  # Upper bound on frames processed per second
+        self.detection_interval = 5  # Detect and recognize every N frames, track in between
+        self.enroll_samples = 8  # Face images captured per new employee
+        self.enroll_duration = 0.5  # Seconds allowed for capturing them
         
         # Setup GPIO
         GPIO.setmode(GPIO.BCM)
@@ -35,13 +51,24 @@ class LightweightFaceAttendance:
                 writer = csv.writer(file)
                 writer.writerow(["Name", "Date", "Time"])
         
+        # Keep the attendance already recorded in memory and the log open for appending
+        self.marked_attendance = self.load_marked_attendance()
+        self.log_file = open(attendance_log, 'a', newline='')
+        self.log_writer = csv.writer(self.log_file)
+        atexit.register(self.close_attendance_log)
+        
         # Load or train the model
         self.load_or_train_model()
     
+    def model_paths(self):
+        """Model and ID mapping paths for the detector in use"""
+        # LBPH is trained on detector crops, so each detector gets its own model
+        detector = self.detector_name()
+        return f"models/face_recognizer_{detector}.yml", f"models/employee_ids_{detector}.csv"
+    
     def load_or_train_model(self):
         """Load existing model or train a new one if necessary"""
-        model_path = "models/face_recognizer.yml"
-        id_map_path = "models/employee_ids.csv"
+        model_path, id_map_path = self.model_paths()
         
         # Check if model and ID mapping exist
         if os.path.exists(model_path) and os.path.exists(id_map_path):
@@ -72,50 +99,226 @@ class LightweightFaceAttendance:
         next_id = 1
         id_map = {}
         
+        # Reuse face crops of images that have not changed since the last training
+        cache = self.load_face_cache()
+        updated_cache = {}
+        
+        # Collect the images in the database
+        with os.scandir(self.database_path) as entries:
+            images = [
+                (entry.name, entry.path, entry.stat().st_mtime)
+                for entry in entries
+                if entry.name.endswith(".jpg") or entry.name.endswith(".png")
+            ]
+        
+        # Decode and detect new or modified images in parallel (OpenCV releases the GIL)
+        stale_paths = [path for filename, path, mtime in images if cache.get(filename, (None,))[0] != mtime]
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            extracted = dict(zip(stale_paths, executor.map(self.extract_face, stale_paths)))
+        
         # Process each image in the database
-        for filename in os.listdir(self.database_path):
-            if filename.endswith(".jpg") or filename.endswith(".png"):
-                # Get employee name from filename (without extension)
-                name = os.path.splitext(filename)[0]
-                
-                # Assign an ID
-                emp_id = next_id
+        name_ids = {}
+        for filename, path, mtime in images:
+            # Get employee name from filename
+            name = self.employee_name(filename)
+            
+            # Assign an ID, shared by all sample images of an employee
+            if name not in name_ids:
+                name_ids[name] = next_id
+                id_map[next_id] = name
                 next_id += 1
-                id_map[emp_id] = name
-                
-                # Load image
-                img_path = os.path.join(self.database_path, filename)
-                img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
-                
-                # Detect faces
-                detected_faces = self.face_cascade.detectMultiScale(
-                    img,
-                    scaleFactor=1.1,
-                    minNeighbors=5,
-                    minSize=(30, 30)
-                )
-                
-                # Add each face to training data
-                for (x, y, w, h) in detected_faces:
-                    faces.append(img[y:y+h, x:x+w])
-                    ids.append(emp_id)
-                    print(f"Processed: {name}")
-                    break  # Use only the first face found in each image
+            emp_id = name_ids[name]
+            
+            face = extracted[path] if path in extracted else cache[filename][1]
+            updated_cache[filename] = (mtime, face)
+            
+            # Add the face to training data
+            if face.size > 0:
+                faces.append(face)
+                ids.append(emp_id)
+                print(f"Processed: {filename}")
+        
+        self.save_face_cache(updated_cache)
         
         # Save ID mapping
         self.employee_ids = id_map
-        with open("models/employee_ids.csv", 'w') as file:
+        model_path, id_map_path = self.model_paths()
+        with open(id_map_path, 'w') as file:
             for emp_id, name in id_map.items():
                 file.write(f"{emp_id},{name}\n")
         
         # Train the model
         if len(faces) > 0:
             self.recognizer.train(faces, np.array(ids))
-            self.recognizer.save("models/face_recognizer.yml")
+            self.recognizer.save(model_path)
             print(f"Model trained and saved with {len(faces)} faces from {len(id_map)} employees.")
         else:
             print("No faces found in the database. Model not trained.")
     
+    def employee_name(self, filename):
+        """Get the employee name from an image filename, e.g. Alice.jpg or Alice.3.jpg"""
+        name = os.path.splitext(filename)[0]
+        base, _, sample = name.rpartition('.')
+        return base if base and sample.isdigit() else name
+    
+    def remove_employee_images(self, name):
+        """Delete all sample images of an employee from the database"""
+        with os.scandir(self.database_path) as entries:
+            paths = [
+                entry.path
+                for entry in entries
+                if (entry.name.endswith(".jpg") or entry.name.endswith(".png"))
+                and self.employee_name(entry.name) == name
+            ]
+        for path in paths:
+            os.remove(path)
+    
+    def yunet_available(self):
+        """Check whether the YuNet face detector can be used instead of the Haar cascade"""
+        if not hasattr(cv2, "FaceDetectorYN"):
+            print("OpenCV has no FaceDetectorYN, using Haar cascade for face detection")
+            return False
+        if not os.path.exists(self.face_detector_model):
+            print(f"{self.face_detector_model} not found, using Haar cascade for face detection")
+            return False
+        
+        # Some OpenCV versions with FaceDetectorYN cannot load newer YuNet models
+        try:
+            cv2.FaceDetectorYN.create(self.face_detector_model, "", self.detection_size)
+        except cv2.error as e:
+            print(f"Could not load {self.face_detector_model} ({e}), using Haar cascade for face detection")
+            return False
+        return True
+    
+    def cuda_available(self):
+        """Check whether OpenCV can run the face detector on a CUDA GPU (e.g. Jetson Nano)"""
+        # Requires OpenCV built with -D WITH_CUDA=ON -D OPENCV_DNN_CUDA=ON
+        try:
+            available = cv2.cuda.getCudaEnabledDeviceCount() > 0
+        except (AttributeError, cv2.error):
+            available = False
+        if available:
+            print("CUDA device found, running face detection on the GPU")
+        return available
+    
+    def detector_name(self):
+        """Name of the face detector in use"""
+        return "yunet" if self.use_yunet else "haar"
+    
+    def thread_detectors(self):
+        """Return the face detector state of the calling thread, creating it on first use"""
+        detectors = self.detectors
+        if not hasattr(detectors, "small_frame"):
+            if self.use_yunet:
+                if self.use_cuda:
+                    backend_id, target_id = cv2.dnn.DNN_BACKEND_CUDA, cv2.dnn.DNN_TARGET_CUDA
+                else:
+                    backend_id, target_id = cv2.dnn.DNN_BACKEND_DEFAULT, cv2.dnn.DNN_TARGET_CPU
+                detectors.face_detector = cv2.FaceDetectorYN.create(
+                    self.face_detector_model, "", self.detection_size,
+                    backend_id=backend_id, target_id=target_id
+                )
+            else:
+                detectors.face_cascade = cv2.CascadeClassifier(self.face_cascade_path)
+            detectors.small_frame = np.empty((self.detection_size[1], self.detection_size[0], 3), dtype=np.uint8)
+        return detectors
+    
+    def detect_faces(self, frame, gray):
+        """Return (x, y, w, h) boxes of the faces found in a frame"""
+        detectors = self.thread_detectors()
+        if not self.use_yunet:
+            return detectors.face_cascade.detectMultiScale(
+                gray,
+                scaleFactor=1.1,
+                minNeighbors=5,
+                minSize=(30, 30)
+            )
+        
+        # YuNet runs on a downscaled copy of the frame, resized into a reused buffer
+        scale = self.detection_size[0] / frame.shape[1]
+        small_size = (self.detection_size[0], round(frame.shape[0] * scale))
+        if detectors.small_frame.shape[:2] != (small_size[1], small_size[0]):
+            detectors.small_frame = np.empty((small_size[1], small_size[0], 3), dtype=np.uint8)
+        cv2.resize(frame, small_size, dst=detectors.small_frame, interpolation=cv2.INTER_AREA)
+        detectors.face_detector.setInputSize(small_size)
+        _, detections = detectors.face_detector.detect(detectors.small_frame)
+        if detections is None:
+            return []
+        
+        # Scale boxes back to the frame, clipped to its borders
+        frame_h, frame_w = gray.shape
+        boxes = []
+        for detection in detections:
+            x, y, w, h = (int(v / scale) for v in detection[:4])
+            x, y = max(x, 0), max(y, 0)
+            w, h = min(w, frame_w - x), min(h, frame_h - y)
+            if w > 0 and h > 0:
+                boxes.append((x, y, w, h))
+        return boxes
+    
+    def extract_face(self, img_path):
+        """Return the grayscale crop of the first face found in an image (empty if none)"""
+        img = cv2.imread(img_path)
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        
+        # Use only the first face found in each image
+        for (x, y, w, h) in self.detect_faces(img, gray):
+            return gray[y:y+h, x:x+w]
+        return np.empty((0, 0), dtype=np.uint8)
+    
+    def face_cache_paths(self):
+        """Pixel buffer and index paths of the face cache for the detector in use"""
+        # Crops from different detectors are cached separately
+        base = f"{self.face_cache_path}_{self.detector_name()}"
+        return base + ".npy", base + ".csv"
+    
+    def load_face_cache(self):
+        """Load cached face crops as a map of filename to (mtime, face)"""
+        pixels_path, index_path = self.face_cache_paths()
+        if not os.path.exists(pixels_path) or not os.path.exists(index_path):
+            return {}
+        
+        # Each index row is filename, mtime, offset, height, width
+        with open(index_path, 'r', newline='') as file:
+            index = [(row[0], float(row[1]), *map(int, row[2:])) for row in csv.reader(file) if len(row) == 5]
+        
+        # The pixel buffer is memory-mapped, so crops are only read when used
+        total = max((offset + h * w for _, _, offset, h, w in index), default=0)
+        pixels = np.load(pixels_path, mmap_mode='r') if total > 0 else np.empty(0, dtype=np.uint8)
+        if total > pixels.size:
+            return {}  # Index and pixel buffer do not match
+        return {
+            filename: (mtime, pixels[offset:offset + h * w].reshape(h, w))
+            for filename, mtime, offset, h, w in index
+        }
+    
+    def save_face_cache(self, cache):
+        """Save face crops so unchanged images are not processed again"""
+        pixels_path, index_path = self.face_cache_paths()
+        
+        # All crops are packed into one contiguous pixel buffer, indexed by offset and shape
+        faces = [face for _, face in cache.values()]
+        pixels = np.concatenate([face.ravel() for face in faces] + [np.empty(0, dtype=np.uint8)])
+        
+        # Write to temporary files and swap them in, as the old buffer may still be mapped
+        with open(pixels_path + ".tmp", 'wb') as file:
+            np.save(file, pixels)
+        with open(index_path + ".tmp", 'w', newline='') as file:
+            writer = csv.writer(file)
+            offset = 0
+            for filename, (mtime, face) in cache.items():
+                writer.writerow([filename, repr(mtime), offset, *face.shape])
+                offset += face.size
+        os.replace(pixels_path + ".tmp", pixels_path)
+        os.replace(index_path + ".tmp", index_path)
+    
+    def load_marked_attendance(self):
+        """Read the attendance log once into a set of (name, date) entries"""
+        with open(self.attendance_log, 'r', newline='') as file:
+            reader = csv.reader(file)
+            next(reader, None)  # Skip header
+            return {(row[0], row[1]) for row in reader if len(row) >= 2}
+    
     def mark_attendance(self, name):
         """Record attendance in the CSV file"""
         now = datetime.now()
@@ -123,18 +326,12 @@ class LightweightFaceAttendance:
         time_str = now.strftime("%H:%M:%S")
         
         # Check if person already marked attendance today
-        already_marked = False
-        if os.path.exists(self.attendance_log):
-            with open(self.attendance_log, 'r') as file:
-                for line in file:
-                    if name in line and date_str in line:
-                        already_marked = True
-                        break
+        entry = (name, date_str)
         
-        if not already_marked:
-            with open(self.attendance_log, 'a', newline='') as file:
-                writer = csv.writer(file)
-                writer.writerow([name, date_str, time_str])
+        if entry not in self.marked_attendance:
+            self.log_writer.writerow([name, date_str, time_str])
+            self.marked_attendance.add(entry)
+            self.flush_attendance_log()  # Each row reaches the file as soon as it is marked
             
             print(f"Attendance marked for {name} at {time_str}")
             # Visual/audio confirmation
@@ -144,6 +341,17 @@ class LightweightFaceAttendance:
             print(f"{name} already marked attendance today")
             return False
     
+    def flush_attendance_log(self):
+        """Write buffered attendance rows to the log file"""
+        self.log_file.flush()
+    
+    def close_attendance_log(self):
+        """Flush and sync the attendance log to disk, then close it"""
+        if not self.log_file.closed:
+            self.flush_attendance_log()
+            os.fsync(self.log_file.fileno())
+            self.log_file.close()
+    
     def success_indication(self):
         """Provide visual/audio feedback on successful recognition"""
         # Blink LED
@@ -154,77 +362,183 @@ class LightweightFaceAttendance:
         GPIO.output(self.led_pin, GPIO.LOW)
         GPIO.output(self.buzzer_pin, GPIO.LOW)
     
+    def configure_camera(self, camera):
+        """Reduce capture latency and bandwidth"""
+        camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Avoid processing stale frames
+        if sys.platform.startswith("linux"):
+            # Compressed frames need less USB/CSI bandwidth under V4L2
+            camera.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+    
+    def capture_loop(self, camera, frame_queue, stop_event):
+        """Capture frames from the camera, keeping only the most recent ones"""
+        while not stop_event.is_set():
+            ret, frame = camera.read()
+            if not ret:
+                print("Failed to capture image")
+                stop_event.set()
+                break
+            self.put_latest(frame_queue, frame)
+    
+    def run_worker(self, worker, stop_event, *args):
+        """Run a pipeline stage, stopping the whole pipeline if it fails"""
+        try:
+            worker(*args, stop_event)
+        except Exception:
+            print(f"Error in {worker.__name__}:")
+            traceback.print_exc()
+        finally:
+            stop_event.set()
+    
+    @staticmethod
+    def put_latest(frame_queue, item):
+        """Put an item on a bounded queue, dropping the oldest item if it is full"""
+        try:
+            frame_queue.put_nowait(item)
+        except queue.Full:
+            try:
+                frame_queue.get_nowait()
+            except queue.Empty:
+                pass
+            frame_queue.put_nowait(item)
+    
+    def recognize_faces(self, frame):
+        """Detect faces in a frame and predict who they belong to"""
+        # Convert to grayscale for face detection
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        
+        # Detect faces
+        faces = self.detect_faces(frame, gray)
+        
+        # Recognize each face found
+        results = []
+        for (x, y, w, h) in faces:
+            face_img = gray[y:y+h, x:x+w]
+            
+            try:
+                # Predict the id and confidence
+                id_num, confidence = self.recognizer.predict(face_img)
+                
+                # Lower confidence means better match (0 is perfect match)
+                matched = confidence < 70  # Confidence threshold
+                name = self.employee_ids.get(id_num, "Unknown") if matched else "Unknown"
+                results.append((x, y, w, h, name, confidence, matched))
+            except Exception as e:
+                print(f"Error during recognition: {e}")
+                results.append((x, y, w, h, None, None, False))
+        
+        return results
+    
+    def recognition_loop(self, frame_queue, result_queue, stop_event):
+        """Detect and recognize faces in captured frames"""
+        frame_idx = 0
+        trackers = []  # (tracker, name, confidence, matched) for each recognized face
+        while not stop_event.is_set():
+            try:
+                frame = frame_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            start_time = time.perf_counter()
+            
+            # Identities do not change between frames, so the detector and
+            # recognizer only run periodically and faces are tracked in between
+            if frame_idx % self.detection_interval == 0:
+                results = self.recognize_faces(frame)
+                trackers = []
+                for (x, y, w, h, name, confidence, matched) in results:
+                    tracker = cv2.legacy.TrackerKCF_create()
+                    tracker.init(frame, (int(x), int(y), int(w), int(h)))
+                    trackers.append((tracker, name, confidence, matched))
+            else:
+                results = []
+                for (tracker, name, confidence, matched) in trackers:
+                    found, box = tracker.update(frame)
+                    if found:
+                        x, y, w, h = (int(v) for v in box)
+                        results.append((x, y, w, h, name, confidence, matched))
+            frame_idx += 1
+            
+            self.put_latest(result_queue, (frame, results))
+            
+            # Only sleep for whatever is left of the frame budget
+            processing_time = time.perf_counter() - start_time
+            time.sleep(max(0, 1 / self.max_fps - processing_time))
+    
+    def poll_key(self):
+        """Return the last key pressed in a window without waiting for one"""
+        # pollKey (OpenCV >= 4.5) returns immediately, waitKey(1) sleeps for a millisecond
+        if hasattr(cv2, "pollKey"):
+            return cv2.pollKey() & 0xFF
+        return cv2.waitKey(1) & 0xFF
+    
     def run(self):
         """Main loop to capture video and process faces"""
         # Initialize camera
         camera = cv2.VideoCapture(0)  # Use 0 for default camera (Pi Camera)
+        self.configure_camera(camera)
         camera.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
         camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
         
+        # Capture -> recognition -> display pipeline connected by bounded queues
+        frame_queue = queue.Queue(maxsize=2)
+        result_queue = queue.Queue(maxsize=2)
+        stop_event = threading.Event()
+        workers = [
+            threading.Thread(target=self.run_worker, args=(self.capture_loop, stop_event, camera, frame_queue), daemon=True),
+            threading.Thread(target=self.run_worker, args=(self.recognition_loop, stop_event, frame_queue, result_queue), daemon=True)
+        ]
+        for worker in workers:
+            worker.start()
+        
         print("Starting face recognition attendance system...")
         print("Press 'q' to quit")
         
         try:
-            while True:
-                # Capture frame
-                ret, frame = camera.read()
-                if not ret:
-                    print("Failed to capture image")
-                    break
-                
-                # Convert to grayscale for face detection
-                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                
-                # Detect faces
-                faces = self.face_cascade.detectMultiScale(
-                    gray,
-                    scaleFactor=1.1,
-                    minNeighbors=5,
-                    minSize=(30, 30)
-                )
+            while not stop_event.is_set():
+                try:
+                    frame, results = result_queue.get(timeout=0.1)
+                except queue.Empty:
+                    # Keep the window responsive while waiting for results
+                    if self.poll_key() == ord('q'):
+                        break
+                    continue
                 
-                # Process each face found
-                for (x, y, w, h) in faces:
+                # Draw each face found
+                recognized = []
+                for (x, y, w, h, name, confidence, matched) in results:
                     # Draw rectangle around the face
                     cv2.rectangle(frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
+                    if name is None:
+                        continue
                     
-                    # Recognize the face
-                    face_img = gray[y:y+h, x:x+w]
+                    confidence_txt = f"{round(100 - confidence)}%"
                     
-                    try:
-                        # Predict the id and confidence
-                        id_num, confidence = self.recognizer.predict(face_img)
-                        
-                        # Lower confidence means better match (0 is perfect match)
-                        if confidence < 70:  # Confidence threshold
-                            name = self.employee_ids.get(id_num, "Unknown")
-                            confidence_txt = f"{round(100 - confidence)}%"
-                            
-                            # Mark attendance
-                            self.mark_attendance(name)
-                        else:
-                            name = "Unknown"
-                            confidence_txt = f"{round(100 - confidence)}%"
-                        
-                        # Display name and confidence
-                        cv2.putText(frame, name, (x+5, y-5), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-                        cv2.putText(frame, confidence_txt, (x+5, y+h+25), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 0), 1)
+                    # Display name and confidence
+                    cv2.putText(frame, name, (x+5, y-5), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+                    cv2.putText(frame, confidence_txt, (x+5, y+h+25), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 0), 1)
                     
-                    except Exception as e:
-                        print(f"Error during recognition: {e}")
+                    if matched:
+                        recognized.append(name)
                 
                 # Display result
                 cv2.imshow('Face Recognition Attendance', frame)
+                key = self.poll_key()
+                
+                # Mark attendance for recognized faces
+                for name in recognized:
+                    self.mark_attendance(name)
                 
                 # Check for quit
-                if cv2.waitKey(1) & 0xFF == ord('q'):
+                if key == ord('q'):
                     break
                 
-                # Short delay to reduce CPU usage
-                time.sleep(0.1)
-                
         finally:
+            # Stop the pipeline before releasing the camera
+            stop_event.set()
+            for worker in workers:
+                worker.join(timeout=1)
+            
             # Cleanup
+            self.flush_attendance_log()
             camera.release()
             cv2.destroyAllWindows()
             GPIO.cleanup()
@@ -233,6 +547,7 @@ class LightweightFaceAttendance:
         """Add a new employee to the database"""
         # Initialize camera
         camera = cv2.VideoCapture(0)
+        self.configure_camera(camera)
         
         print(f"Adding new employee: {name}")
         print("Position face in front of camera")
@@ -250,12 +565,7 @@ class LightweightFaceAttendance:
                 gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
                 
                 # Detect faces
-                faces = self.face_cascade.detectMultiScale(
-                    gray,
-                    scaleFactor=1.1,
-                    minNeighbors=5,
-                    minSize=(30, 30)
-                )
+                faces = self.detect_faces(frame, gray)
                 
                 # Draw rectangle around detected faces
                 for (x, y, w, h) in faces:
@@ -264,18 +574,36 @@ class LightweightFaceAttendance:
                 # Display frame
                 cv2.imshow('Add Employee', frame)
                 
-                key = cv2.waitKey(1) & 0xFF
+                key = self.poll_key()
                 
                 if key == ord('c'):
                     if len(faces) > 0:
-                        # Save the image
-                        filename = os.path.join(self.database_path, f"{name}.jpg")
-                        cv2.imwrite(filename, frame)
-                        print(f"Successfully captured {name}'s face image")
+                        # Capture a short burst of clean frames so the model gets several samples
+                        samples = []
+                        deadline = time.perf_counter() + self.enroll_duration
+                        while len(samples) < self.enroll_samples and time.perf_counter() < deadline:
+                            ret, sample = camera.read()
+                            if not ret:
+                                break
+                            sample_gray = cv2.cvtColor(sample, cv2.COLOR_BGR2GRAY)
+                            if len(self.detect_faces(sample, sample_gray)) > 0:
+                                samples.append(sample)
                         
-                        # Retrain the model with new data
-                        self.train_model()
-                        break
+                        if samples:
+                            # Replace any samples left from an earlier enrolment
+                            self.remove_employee_images(name)
+                            
+                            # Save the images as name.jpg, name.1.jpg, name.2.jpg, ...
+                            for i, sample in enumerate(samples):
+                                suffix = f".{i}" if i > 0 else ""
+                                filename = os.path.join(self.database_path, f"{name}{suffix}.jpg")
+                                cv2.imwrite(filename, sample)
+                            print(f"Successfully captured {len(samples)} images of {name}'s face")
+                            
+                            # Retrain the model once with all new data
+                            self.train_model()
+                            break
+                        print("Face lost while capturing! Please try again.")
                     else:
                         print("No face detected! Please try again.")
                 